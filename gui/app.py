@@ -6,28 +6,91 @@ Backup: Brave Search + Firecrawl for deep extraction
 
 import streamlit as st
 import json
+import html
 import os
+import re
 import hashlib
-from datetime import datetime
+import hmac
+import threading
+import sqlite3
+import uuid
+import time
+import asyncio
+import functools
+import contextlib
+from contextlib import closing
+from collections import OrderedDict
+from datetime import datetime, timedelta
 
 # Core imports
 try:
     import anthropic
-    import pandas as pd
     import httpx
 except ImportError as e:
     st.error(f"Missing dependency: {e}")
     st.stop()
 
+import cache as response_cache
+from urls import canonical_url
+
 # ============ Configuration ============
 
 MODEL = "claude-sonnet-4-20250514"
+HAIKU_MODEL = "claude-3-5-haiku-latest"
 WEB_SEARCH_BETA = "web-search-2025-03-05"
+PROMPT_CACHING_BETA = "prompt-caching-2024-07-31"
+BETA_HEADERS = {"anthropic-beta": f"{WEB_SEARCH_BETA},{PROMPT_CACHING_BETA}"}
 
 # Cost per 1M tokens
 COSTS = {
     "claude-sonnet-4-20250514": {"input": 3.0, "output": 15.0},
+    "claude-3-5-haiku-latest": {"input": 0.8, "output": 4.0},
 }
+MODEL_FAMILIES = ("opus", "sonnet", "haiku")
+
+# Prompt caching: reads bill at 10% of input, writes at 125%
+CACHE_READ_MULTIPLIER = 0.1
+CACHE_WRITE_MULTIPLIER = 1.25
+EPHEMERAL = {"type": "ephemeral"}
+
+MAX_SOURCES = 10
+
+# Openers that unambiguously continue the previous research: they point back at it.
+# Generic openers ("why", "and", "more") start fresh questions too, so they go to the classifier.
+FOLLOWUP_RE = re.compile(
+    r'^(what about|how about|and the|tell me more|more (on|about) (that|this|it)'
+    r'|(expand|elaborate) on (that|this|it)|why (is|was) that)\b',
+    re.I
+)
+
+# Token budget for earlier findings injected into follow-up prompts
+FOLLOWUP_CONTEXT_TOKENS = 800
+
+# Session spend above which a query needs explicit confirmation
+DEFAULT_BUDGET = 5.0
+
+# Research results shared across sessions, keyed by normalized query
+RESEARCH_CACHE_TTL = 3600
+RESEARCH_CACHE_MAX_ENTRIES = 128
+QUERY_STOPWORDS = frozenset(
+    "a an and are between do does for how in is of on or the to vs versus what which with".split()
+)
+
+# Several queued questions answered in one call share the instructions and tools
+COMBINED_MAX_QUERIES = 5
+ANSWER_DELIMITER = "===ANSWER {i}==="
+ANSWER_SPLIT_RE = re.compile(r"^===ANSWER (\d+)===\s*$", re.M)
+
+# Message Batches API: half price, results arrive asynchronously
+BATCH_DISCOUNT = 0.5
+BATCH_POLL_SECONDS = 10
+BATCH_MAX_WAIT_SECONDS = 300  # then the batch is left running and collected on a later click
+STREAM_STALL_SECONDS = 60  # web searches run server-side between events, so allow for them
+
+# Research history lives on disk, not in session state
+HISTORY_DB = os.environ.get("HISTORY_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "history.db"))
+HISTORY_LIMIT = 10
+HISTORY_RETENTION_DAYS = 7  # sessions idle longer than this are deleted
 
 # ============ Page Config ============
 
@@ -40,135 +103,23 @@ st.set_page_config(
 
 # ============ Styles ============
 
-st.markdown("""
-<style>
-    #MainMenu, footer, header, .stDeployButton {display: none !important;}
+CSS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "app.css")
 
-    .main .block-container {
-        max-width: 52rem;
-        padding: 1rem 1rem 8rem 1rem;
-    }
 
-    .app-header {
-        text-align: center;
-        padding: 1.5rem 0;
-        border-bottom: 1px solid #e5e5e5;
-        margin-bottom: 1.5rem;
-    }
-    .app-header h1 {
-        font-size: 1.75rem;
-        font-weight: 600;
-        margin: 0;
-        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-        -webkit-background-clip: text;
-        -webkit-text-fill-color: transparent;
-    }
-    .app-header p {
-        color: #666;
-        margin: 0.5rem 0 0 0;
-        font-size: 0.95rem;
-    }
+_CSS_COMMENT_RE = re.compile(r"/\*.*?\*/", re.S)
+_CSS_SPACE_RE = re.compile(r"\s*([{};,>])\s*|\s+")
 
-    .status-bar {
-        display: flex;
-        gap: 0.5rem;
-        justify-content: center;
-        margin-top: 0.75rem;
-        flex-wrap: wrap;
-    }
-    .badge {
-        font-size: 0.7rem;
-        padding: 0.2rem 0.6rem;
-        border-radius: 1rem;
-        background: #f0f0f0;
-        color: #666;
-    }
-    .badge.active {
-        background: #d1fae5;
-        color: #065f46;
-    }
 
-    .user-msg {
-        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-        color: white;
-        padding: 0.875rem 1.25rem;
-        border-radius: 1.25rem 1.25rem 0.25rem 1.25rem;
-        margin: 1rem 0 1rem auto;
-        max-width: 80%;
-        width: fit-content;
-    }
+@st.cache_resource
+def _css():
+    """Stylesheet read from disk and minified once per process."""
+    with open(CSS_PATH) as f:
+        css = _CSS_COMMENT_RE.sub("", f.read())
+    css = _CSS_SPACE_RE.sub(lambda m: m.group(1) or " ", css).strip()
+    return f"<style>{css}</style>"
 
-    .assistant-msg {
-        padding: 0.5rem 0;
-        line-height: 1.7;
-    }
 
-    .citation {
-        display: inline-block;
-        background: #e8f4f8;
-        color: #0369a1;
-        padding: 0.1rem 0.4rem;
-        border-radius: 0.25rem;
-        font-size: 0.75rem;
-        text-decoration: none;
-        margin: 0 0.1rem;
-    }
-    .citation:hover {
-        background: #0369a1;
-        color: white;
-    }
-
-    .sources-list {
-        background: #f8fafc;
-        border: 1px solid #e2e8f0;
-        border-radius: 0.5rem;
-        padding: 1rem;
-        margin: 1rem 0;
-    }
-    .source-item {
-        padding: 0.5rem 0;
-        border-bottom: 1px solid #e2e8f0;
-        font-size: 0.9rem;
-    }
-    .source-item:last-child {
-        border-bottom: none;
-    }
-    .source-item a {
-        color: #0369a1;
-        text-decoration: none;
-    }
-    .source-item a:hover {
-        text-decoration: underline;
-    }
-    .source-title {
-        font-weight: 500;
-    }
-    .source-url {
-        color: #64748b;
-        font-size: 0.8rem;
-    }
-
-    .cost-badge {
-        position: fixed;
-        bottom: 5rem;
-        right: 1rem;
-        background: white;
-        border: 1px solid #e5e5e5;
-        border-radius: 0.5rem;
-        padding: 0.4rem 0.75rem;
-        font-size: 0.75rem;
-        color: #666;
-        box-shadow: 0 2px 8px rgba(0,0,0,0.1);
-        z-index: 100;
-    }
-
-    .thinking {
-        color: #666;
-        font-style: italic;
-        padding: 0.5rem 0;
-    }
-</style>
-""", unsafe_allow_html=True)
+st.markdown(_css(), unsafe_allow_html=True)
 
 
 # ============ Helper Functions ============
@@ -182,15 +133,31 @@ def get_secret(key, default=""):
     return os.environ.get(key, default)
 
 
-def check_password():
+def _password_digest(password):
+    return hashlib.sha256(password.encode()).digest()
+
+
+@st.cache_resource
+def _credentials():
+    """{username: sha256(password)}, parsed from secrets once per process."""
     passwords = {}
     try:
         if hasattr(st, 'secrets') and 'passwords' in st.secrets:
             passwords = dict(st.secrets["passwords"])
     except:
         pass
+    return {user: _password_digest(str(pw)) for user, pw in passwords.items()}
+
+
+def verify_credentials(username, password):
+    """Constant-time check; unknown users still pay for a comparison."""
+    credentials = _credentials()
+    expected = credentials.get(username, _password_digest(""))
+    return hmac.compare_digest(_password_digest(password), expected) and username in credentials
 
-    if not passwords:
+
+def check_password():
+    if not _credentials():
         return True
 
     if st.session_state.get('authenticated'):
@@ -204,7 +171,7 @@ def check_password():
             username = st.text_input("Username")
             password = st.text_input("Password", type="password")
             if st.form_submit_button("Continue", use_container_width=True, type="primary"):
-                if username in passwords and passwords[username] == password:
+                if verify_credentials(username, password):
                     st.session_state.authenticated = True
                     st.rerun()
                 else:
@@ -215,51 +182,202 @@ def check_password():
 def init_state():
     defaults = {
         'messages': [],
-        'history': [],
+        'session_id': uuid.uuid4().hex,
         'total_cost': 0.0,
         'session_cost': 0.0,
+        'cost_by_model': {},
+        'batch_queue': [],
+        'pending_batches': [],  # batches that outlived BATCH_MAX_WAIT_SECONDS
+        'force_refresh': False,
+        'budget': DEFAULT_BUDGET,
+        'over_budget_query': None,
+        'history_head': None,   # history row the current messages were last saved as
+        'history_saved': 0,     # how many of the current messages that row covers
     }
     for k, v in defaults.items():
         if k not in st.session_state:
             st.session_state[k] = v
 
 
+@st.cache_resource(show_spinner=False)
+def _build_client(api_key):
+    """One Anthropic client (and HTTP/2 connection pool) per key, shared across reruns."""
+    return anthropic.Anthropic(
+        api_key=api_key,
+        http_client=httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=50)
+        )
+    )
+
+
+@st.cache_resource
+def _history_db():
+    """Create the history table once per process; returns the database path."""
+    with closing(sqlite3.connect(HISTORY_DB)) as conn, conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                query TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                messages_json TEXT NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS history_session ON history (session_id, id)")
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(history)")}
+        if "base_id" not in columns:
+            # Rows written before base_id hold full snapshots, so NULL ends a chain correctly
+            conn.execute("ALTER TABLE history ADD COLUMN base_id INTEGER")
+        _prune_history(conn)
+    return HISTORY_DB
+
+
+def _prune_history(conn):
+    """
+    Delete every session whose newest row is older than HISTORY_RETENTION_DAYS.
+    Rows are only readable from the session that wrote them, so once it has
+    ended they are dead weight. Whole sessions go at once to keep delta chains intact.
+    """
+    cutoff = (datetime.now() - timedelta(days=HISTORY_RETENTION_DAYS)).isoformat()
+    conn.execute(
+        "DELETE FROM history WHERE session_id IN "
+        "(SELECT session_id FROM history GROUP BY session_id HAVING MAX(timestamp) < ?)",
+        (cutoff,)
+    )
+
+
+def save_history(query, messages):
+    """
+    Store only the messages added since the last save, linked to that row,
+    so history grows with the conversation instead of with its square.
+    """
+    new_messages = messages[st.session_state.history_saved:]
+    with closing(sqlite3.connect(_history_db())) as conn, conn:
+        cursor = conn.execute(
+            "INSERT INTO history (session_id, query, timestamp, messages_json, base_id) VALUES (?, ?, ?, ?, ?)",
+            (st.session_state.session_id, query, datetime.now().isoformat(),
+             json.dumps(new_messages, default=str, separators=(',', ':')), st.session_state.history_head)
+        )
+        _prune_history(conn)
+    st.session_state.history_head = cursor.lastrowid
+    st.session_state.history_saved = len(messages)
+
+
+def recent_history(limit=HISTORY_LIMIT):
+    """[(id, query)] for this session, newest first."""
+    with closing(sqlite3.connect(_history_db())) as conn:
+        return conn.execute(
+            "SELECT id, query FROM history WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+            (st.session_state.session_id, limit)
+        ).fetchall()
+
+
+def load_history(history_id):
+    """Rebuild a saved conversation by following its chain of message deltas."""
+    chunks = []
+    with closing(sqlite3.connect(_history_db())) as conn:
+        row_id = history_id
+        while row_id is not None:
+            row = conn.execute(
+                "SELECT messages_json, base_id FROM history WHERE id = ? AND session_id = ?",
+                (row_id, st.session_state.session_id)
+            ).fetchone()
+            if row is None:
+                break
+            chunks.append(json.loads(row[0]))
+            row_id = row[1]
+    if not chunks:
+        return None
+    messages = [msg for chunk in reversed(chunks) for msg in chunk]
+    st.session_state.history_head = history_id
+    st.session_state.history_saved = len(messages)
+    return messages
+
+
 def get_client():
     key = get_secret('ANTHROPIC_API_KEY')
     if not key:
         return None
-    return anthropic.Anthropic(api_key=key)
+    return _build_client(key)
+
+
+def _build_async_client(api_key):
+    """
+    Async client for a single submission. Not cached: its connection pool is
+    bound to the event loop that asyncio.run creates for each query.
+    """
+    return anthropic.AsyncAnthropic(
+        api_key=api_key,
+        http_client=httpx.AsyncClient(http2=True)
+    )
 
 
-def track_cost(input_tokens, output_tokens):
-    cost = (input_tokens * COSTS[MODEL]["input"] + output_tokens * COSTS[MODEL]["output"]) / 1_000_000
+@functools.lru_cache(maxsize=64)
+def model_rates(model):
+    """
+    (input, output) $ per million tokens. Unlisted model ids are priced like a
+    listed model of the same family, and anything else like MODEL.
+    """
+    rates = COSTS.get(model)
+    if rates is None:
+        family = next((f for f in MODEL_FAMILIES if f in model.lower()), None)
+        rates = next((r for m, r in COSTS.items() if family and family in m), COSTS[MODEL])
+    return rates["input"], rates["output"]
+
+
+def compute_cost(input_tokens, output_tokens, cache_read_tokens=0, cache_creation_tokens=0, batch=False, model=MODEL):
+    input_rate, output_rate = model_rates(model)
+    cost = (
+        input_tokens * input_rate
+        + cache_read_tokens * input_rate * CACHE_READ_MULTIPLIER
+        + cache_creation_tokens * input_rate * CACHE_WRITE_MULTIPLIER
+        + output_tokens * output_rate
+    ) / 1_000_000
+    if batch:
+        cost *= BATCH_DISCOUNT
+    return cost
+
+
+def add_cost(cost, model=MODEL):
+    """Record already-computed spend. Callers with many responses sum first and call this once."""
     st.session_state.session_cost += cost
     st.session_state.total_cost += cost
+    # Running per-model totals, so rollups never re-walk past calls
+    by_model = st.session_state.cost_by_model
+    by_model[model] = by_model.get(model, 0.0) + cost
     return cost
 
 
-# ============ Claude Web Search ============
+def track_cost(input_tokens, output_tokens, cache_read_tokens=0, cache_creation_tokens=0, batch=False, model=MODEL):
+    return add_cost(
+        compute_cost(input_tokens, output_tokens, cache_read_tokens, cache_creation_tokens, batch, model),
+        model
+    )
+
+
+def usage_cost(usage, batch=False, model=MODEL):
+    """Cost of a response's usage block, including prompt cache tokens."""
+    return compute_cost(
+        usage.input_tokens,
+        usage.output_tokens,
+        cache_read_tokens=getattr(usage, 'cache_read_input_tokens', 0) or 0,
+        cache_creation_tokens=getattr(usage, 'cache_creation_input_tokens', 0) or 0,
+        batch=batch,
+        model=model
+    )
 
-def research_with_web_search(client, query, max_searches=5):
-    """
-    Use Claude's built-in web search for grounded research.
-    Returns structured response with text and citations.
-    """
-    try:
-        response = client.messages.create(
-            model=MODEL,
-            max_tokens=4096,
-            extra_headers={"anthropic-beta": WEB_SEARCH_BETA},
-            tools=[{
-                "type": "web_search_20250305",
-                "name": "web_search",
-                "max_uses": max_searches
-            }],
-            messages=[{
-                "role": "user",
-                "content": f"""Research the following topic and provide a comprehensive, well-organized response:
 
-{query}
+def track_usage(usage, batch=False, model=MODEL):
+    """Track cost from a response's usage block, including prompt cache tokens."""
+    return add_cost(usage_cost(usage, batch, model), model)
+
+
+# ============ Claude Web Search ============
+
+# Static prompt prefixes are sent as cached system blocks so repeat calls
+# only pay full price for the user's query.
+RESEARCH_INSTRUCTIONS = """Research the topic the user gives you and provide a comprehensive, well-organized response.
 
 Requirements:
 1. Search for current, accurate information
@@ -268,81 +386,470 @@ Requirements:
 4. Organize with clear headings and bullet points
 5. If comparing items, create a summary table at the end
 6. Be specific and cite your sources"""
-            }]
+
+FOLLOWUP_INSTRUCTIONS = """You are answering a follow-up question about earlier research.
+Answer the follow-up question. Search for additional information if needed."""
+
+
+def _web_search_tools(max_uses):
+    return [{
+        "type": "web_search_20250305",
+        "name": "web_search",
+        "max_uses": max_uses,
+        "cache_control": EPHEMERAL
+    }]
+
+
+def _cached_system(text):
+    return [{"type": "text", "text": text, "cache_control": EPHEMERAL}]
+
+
+def _research_params(query, max_searches=5):
+    """Request parameters shared by the interactive and batched research paths."""
+    return {
+        'model': MODEL,
+        'max_tokens': 4096,
+        'system': _cached_system(RESEARCH_INSTRUCTIONS),
+        'tools': _web_search_tools(max_searches),
+        'messages': [{"role": "user", "content": query}]
+    }
+
+
+def _parse_research_response(response, block_separator=""):
+    """
+    Pull text, deduped sources and usage out of a web search response.
+    Text blocks are joined with block_separator.
+    """
+    texts = []
+    sources = {}  # canonical url -> source, in first-seen order
+
+    for block in response.content:
+        if block.type == "text":
+            texts.append(block.text)
+        elif block.type == "web_search_tool_result" and len(sources) < MAX_SOURCES:
+            for result in block.content:
+                if not hasattr(result, 'url'):
+                    continue
+                url = canonical_url(result.url)
+                if url in sources:
+                    continue
+                sources[url] = {
+                    'url': result.url,
+                    'title': getattr(result, 'title', ''),
+                    'snippet': getattr(result, 'snippet', getattr(result, 'encrypted_content', ''))[:200]
+                }
+                if len(sources) >= MAX_SOURCES:
+                    break
+
+    return {
+        'text': block_separator.join(texts),
+        'sources': list(sources.values()),
+        'search_count': getattr(response.usage.server_tool_use, 'web_search_requests', 0) if hasattr(response.usage, 'server_tool_use') else 0,
+        'input_tokens': response.usage.input_tokens,
+        'output_tokens': response.usage.output_tokens,
+        'success': True
+    }
+
+
+def _research_error(error):
+    return {
+        'text': f"Error during research: {error}",
+        'sources': [],
+        'success': False,
+        'error': str(error)
+    }
+
+
+def _query_id(query):
+    """
+    Stable id for a query, used as the research cache key and batch custom_id.
+    Case and whitespace are normalized so trivially different phrasings share an id.
+    """
+    normalized = re.sub(r"\s+", " ", query.strip().lower())
+    return hashlib.blake2b(normalized.encode(), digest_size=8).hexdigest()
+
+
+def _query_terms(query):
+    """
+    Content words cut to 4-letter stems, so rephrasings like "compare pricing"
+    and "price comparison" produce the same terms.
+    """
+    words = re.findall(r"[a-z0-9]+", query.lower())
+    return frozenset(w[:4] for w in words if w not in QUERY_STOPWORDS)
+
+
+@st.cache_resource
+def _research_cache():
+    """Process-wide LRU of {(query_id, max_searches): (timestamp, result, query, terms, session_id)}."""
+    return OrderedDict(), threading.Lock()
+
+
+def _similar_research(query, max_searches):
+    """
+    Fresh LRU entry for a rephrasing of the query, or None. Only an exact match
+    of terms counts: one extra qualifier ("in 2023", "for startups") is a different question.
+    The original wording is only shown back to the session that asked it.
+    """
+    terms = _query_terms(query)
+    if not terms:
+        return None
+    cache, lock = _research_cache()
+    now = time.time()
+    with lock:
+        for (_, searches), (ts, result, original, other, session_id) in reversed(cache.items()):
+            if searches == max_searches and other == terms and now - ts <= RESEARCH_CACHE_TTL:
+                break
+        else:
+            return None
+    if session_id != st.session_state.get('session_id'):
+        original = None
+    return {**result, 'cached': True, 'similar_to': original}
+
+
+def clear_research_cache():
+    """Forget every cached research result, in memory and on disk."""
+    cache, lock = _research_cache()
+    with lock:
+        cache.clear()
+    response_cache.clear()
+    _research_json.clear()
+
+
+def get_cached_research(query, max_searches=5):
+    """In-process LRU first, then the on-disk cache that survives restarts, then a rephrased match."""
+    cache, lock = _research_cache()
+    key = (_query_id(query), max_searches)
+    with lock:
+        entry = cache.get(key)
+        if entry is not None and time.time() - entry[0] > RESEARCH_CACHE_TTL:
+            del cache[key]
+            entry = None
+        if entry is not None:
+            cache.move_to_end(key)
+            return {**entry[1], 'cached': True}
+
+    result = response_cache.get(response_cache.make_key('research', *key), ttl=RESEARCH_CACHE_TTL)
+    if result is None:
+        return _similar_research(query, max_searches)
+    store_research(query, result, max_searches, persist=False)
+    return {**result, 'cached': True}
+
+
+def store_research(query, result, max_searches=5, persist=True):
+    if not result.get('success'):
+        return
+    cache, lock = _research_cache()
+    key = (_query_id(query), max_searches)
+    with lock:
+        cache[key] = (time.time(), result, query, _query_terms(query), st.session_state.get('session_id'))
+        while len(cache) > RESEARCH_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+    if persist:
+        response_cache.put(response_cache.make_key('research', *key), result)
+
+
+async def _stream_message(client, placeholder=None, **params):
+    """
+    Stream a response, rendering text into the placeholder as it arrives. Returns the final message.
+    Raises TimeoutError if the stream goes STREAM_STALL_SECONDS without any event.
+    A stream that is cancelled or stalls has still been billed for what it used so far,
+    so that partial usage is tracked before the error propagates.
+    """
+    async with client.messages.stream(**params) as stream:
+        events = stream.__aiter__()
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(events.__anext__(), STREAM_STALL_SECONDS)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    raise TimeoutError(f"no response for {STREAM_STALL_SECONDS}s") from None
+                if event.type == "text" and placeholder is not None:
+                    placeholder.markdown(event.snapshot)
+        except (asyncio.CancelledError, TimeoutError):
+            _track_partial_usage(stream, params['model'])
+            raise
+        return await stream.get_final_message()
+
+
+def _track_partial_usage(stream, model):
+    """Track the usage of an unfinished stream, if its message_start has arrived."""
+    try:
+        usage = stream.current_message_snapshot.usage
+    except (AssertionError, AttributeError):
+        return
+    track_usage(usage, model=model)
+
+
+async def research_with_web_search(client, query, max_searches=5, use_cache=True, placeholder=None):
+    """
+    Use Claude's built-in web search for grounded research.
+    Streams text into the placeholder when given.
+    Returns structured response with text and citations.
+    """
+    if use_cache:
+        cached = get_cached_research(query, max_searches)
+        if cached:
+            return cached
+
+    try:
+        response = await _stream_message(
+            client,
+            placeholder,
+            extra_headers=BETA_HEADERS,
+            **_research_params(query, max_searches)
         )
 
         # Track cost
-        track_cost(response.usage.input_tokens, response.usage.output_tokens)
+        track_usage(response.usage)
 
-        # Parse response
-        text_content = ""
-        sources = []
-        search_queries_used = []
+        result = _parse_research_response(response)
+        store_research(query, result, max_searches)
+        return result
 
-        for block in response.content:
-            if block.type == "text":
-                text_content += block.text
-            elif block.type == "web_search_tool_result":
-                for result in block.content:
-                    if hasattr(result, 'url'):
-                        sources.append({
-                            'url': result.url,
-                            'title': getattr(result, 'title', ''),
-                            'snippet': getattr(result, 'snippet', getattr(result, 'encrypted_content', ''))[:200]
-                        })
-
-        # Dedupe sources by URL
-        seen = set()
-        unique_sources = []
-        for s in sources:
-            if s['url'] not in seen:
-                seen.add(s['url'])
-                unique_sources.append(s)
-
-        return {
-            'text': text_content,
-            'sources': unique_sources[:10],  # Top 10 sources
-            'search_count': getattr(response.usage.server_tool_use, 'web_search_requests', 0) if hasattr(response.usage, 'server_tool_use') else 0,
-            'input_tokens': response.usage.input_tokens,
-            'output_tokens': response.usage.output_tokens,
-            'success': True
-        }
+    except Exception as e:
+        return _research_error(e)
+
+
+def _estimate_cost(client, params):
+    """
+    Preflight cost of a call: counted prompt tokens plus a full max_tokens reply,
+    at the call's model rates. Web search results are not included, so treat it
+    as a lower bound. Returns 0.0 if token counting fails.
+    """
+    try:
+        count = client.messages.count_tokens(
+            extra_headers=BETA_HEADERS,
+            model=params['model'],
+            system=params['system'],
+            tools=params['tools'],
+            messages=params['messages']
+        ).input_tokens
+    except Exception:
+        return 0.0
+    input_rate, output_rate = model_rates(params['model'])
+    return (count * input_rate + params['max_tokens'] * output_rate) / 1_000_000
+
+
+def estimate_research_cost(client, query, max_searches=5):
+    return _estimate_cost(client, _research_params(query, max_searches))
+
+
+def estimate_followup_cost(client, question, context):
+    return _estimate_cost(client, _followup_params(question, context))
+
+
+def over_budget(projected):
+    return st.session_state.session_cost + projected > st.session_state.budget
+
+
+def preflight_query(client, api_key, query, context=None):
+    """
+    (route, projected cost) for the budget check. Queries are priced as research;
+    only when that would break the budget and earlier research is on screen is the
+    query routed first, so a follow-up is priced at the follow-up model's rates.
+    route is None when the query was not routed.
+    """
+    projected = estimate_research_cost(client, query)
+    if context is None or not over_budget(projected):
+        return None, projected
+    if FOLLOWUP_RE.match(query) or asyncio.run(_classify(api_key, query, context)):
+        return 'followup', estimate_followup_cost(client, query, context)
+    return 'research', projected
+
+
+def trim_to_tokens(client, text, max_tokens=FOLLOWUP_CONTEXT_TOKENS):
+    """
+    Cut text to about max_tokens. One count_tokens call measures the
+    chars-per-token ratio, then the cut lands on a line boundary so
+    citations and table rows are not chopped in half.
+    """
+    try:
+        tokens = client.messages.count_tokens(
+            model=HAIKU_MODEL,
+            messages=[{"role": "user", "content": text}]
+        ).input_tokens
+    except Exception:
+        tokens = len(text) // 4  # rough chars-per-token fallback
+    if tokens <= max_tokens:
+        return text
+
+    cut = text[:int(len(text) * max_tokens / tokens)]
+    line_end = cut.rfind("\n")
+    return cut[:line_end] if line_end > len(cut) // 2 else cut
+
+
+def _collect_batch(client, batch_id, ids, max_searches):
+    """{query: result} for every request of an ended batch, priced at the batch discount."""
+    results = {}
+    batch_cost = 0.0
+    for entry in client.messages.batches.results(batch_id):
+        query = ids.get(entry.custom_id)
+        if query is None:
+            continue
+        if entry.result.type == "succeeded":
+            message = entry.result.message
+            batch_cost += usage_cost(message.usage, batch=True)
+            results[query] = _parse_research_response(message)
+            store_research(query, results[query], max_searches)
+        else:
+            results[query] = _research_error(f"batch request {entry.result.type}")
+    add_cost(batch_cost)
+
+    for q in ids.values():
+        results.setdefault(q, _research_error("missing from batch results"))
+    return results
+
+
+def research_with_web_search_batched(client, queries, max_searches=5, on_progress=None):
+    """
+    Research several queries through the Message Batches API at half price.
+    Waits up to BATCH_MAX_WAIT_SECONDS for the batch to end, so only use it for queued research.
+    on_progress(done, total) is called after each poll.
+    Returns {query: result} with the same result shape as research_with_web_search.
+    Queries whose batch is still running are left out and recorded in
+    st.session_state.pending_batches for collect_pending_batches.
+    """
+    results = {}
+    for q in queries:
+        cached = get_cached_research(q, max_searches)
+        if cached:
+            results[q] = cached
+
+    ids = {_query_id(q): q for q in queries if q not in results}
+    if not ids:
+        return results
+
+    try:
+        batch = client.messages.batches.create(
+            extra_headers=BETA_HEADERS,
+            requests=[
+                {"custom_id": custom_id, "params": _research_params(q, max_searches)}
+                for custom_id, q in ids.items()
+            ]
+        )
+
+        deadline = time.monotonic() + BATCH_MAX_WAIT_SECONDS
+        while batch.processing_status != "ended":
+            if time.monotonic() >= deadline:
+                st.session_state.pending_batches.append(
+                    {'batch_id': batch.id, 'ids': ids, 'max_searches': max_searches}
+                )
+                return results
+            time.sleep(BATCH_POLL_SECONDS)
+            batch = client.messages.batches.retrieve(batch.id)
+            if on_progress:
+                on_progress(len(ids) - batch.request_counts.processing, len(ids))
+
+        results.update(_collect_batch(client, batch.id, ids, max_searches))
+        return results
 
     except Exception as e:
-        return {
-            'text': f"Error during research: {str(e)}",
-            'sources': [],
-            'success': False,
-            'error': str(e)
-        }
+        return {q: results.get(q) or _research_error(e) for q in queries}
 
 
-def answer_followup(client, question, context):
-    """Answer follow-up question using previous research context."""
+def collect_pending_batches(client):
+    """
+    Check batches left running by research_with_web_search_batched.
+    Returns {query: result} for those that have ended since; the rest stay pending.
+    """
+    results = {}
+    still_running = []
+    for pending in st.session_state.pending_batches:
+        try:
+            batch = client.messages.batches.retrieve(pending['batch_id'])
+            if batch.processing_status != "ended":
+                still_running.append(pending)
+                continue
+            results.update(_collect_batch(client, pending['batch_id'], pending['ids'], pending['max_searches']))
+        except Exception as e:
+            results.update({q: _research_error(e) for q in pending['ids'].values()})
+    st.session_state.pending_batches = still_running
+    return results
+
+
+def _split_answers(text):
+    """{question number: answer} from a combined response's ===ANSWER N=== sections."""
+    parts = ANSWER_SPLIT_RE.split(text)
+    return {int(num): answer.strip() for num, answer in zip(parts[1::2], parts[2::2])}
+
+
+def research_with_web_search_combined(client, queries, max_searches=5):
+    """
+    Answer up to COMBINED_MAX_QUERIES questions in a single call, so the cached
+    instructions and tool block are paid once instead of once per question.
+    Sources cannot be attributed per answer, so every answer lists all of them.
+    Returns {query: result} with the same result shape as research_with_web_search.
+    """
+    results = {}
+    for q in queries:
+        cached = get_cached_research(q, max_searches)
+        if cached:
+            results[q] = cached
+
+    pending = [q for q in queries if q not in results]
+    if not pending:
+        return results
+
+    numbered = "\n".join(f"Q{i}: {q}" for i, q in enumerate(pending, 1))
+    prompt = f"""Answer the following {len(pending)} research questions independently.
+Start each answer with a line containing only {ANSWER_DELIMITER.format(i='N')}, where N is the question number.
+
+{numbered}"""
+
     try:
-        response = client.messages.create(
-            model=MODEL,
-            max_tokens=2048,
-            extra_headers={"anthropic-beta": WEB_SEARCH_BETA},
-            tools=[{
-                "type": "web_search_20250305",
-                "name": "web_search",
-                "max_uses": 3
-            }],
-            messages=[{
-                "role": "user",
-                "content": f"""Previous research topic: {context.get('query', 'Unknown')}
+        params = _research_params(prompt, max_searches * len(pending))
+        params['max_tokens'] = 4096 * len(pending)
+        response = client.messages.create(extra_headers=BETA_HEADERS, **params)
+
+        track_usage(response.usage)
+
+        # Newline-joined so a delimiter opening a later text block still starts a line
+        combined = _parse_research_response(response, block_separator="\n")
+        answers = _split_answers(combined['text'])
+
+        for i, q in enumerate(pending, 1):
+            if answers.get(i):
+                results[q] = {**combined, 'text': answers[i]}
+                store_research(q, results[q], max_searches)
+            else:
+                results[q] = _research_error("no answer found in combined response")
+        return results
+
+    except Exception as e:
+        return {q: results.get(q) or _research_error(e) for q in queries}
+
+
+def _followup_params(question, context):
+    return {
+        "model": HAIKU_MODEL,
+        "max_tokens": 1024,
+        "system": _cached_system(FOLLOWUP_INSTRUCTIONS),
+        "tools": _web_search_tools(3),
+        "messages": [{
+            "role": "user",
+            "content": f"""Previous research topic: {context.get('query', 'Unknown')}
 
 Previous findings summary:
-{context.get('text', '')[:2000]}
+{context.get('followup_context') or context.get('text', '')[:2000]}
 
-Follow-up question: {question}
+Follow-up question: {question}"""
+        }]
+    }
 
-Answer the follow-up question. Search for additional information if needed."""
-            }]
+
+async def answer_followup(client, question, context, placeholder=None):
+    """Answer follow-up question using previous research context (Haiku is plenty for these)."""
+    try:
+        response = await _stream_message(
+            client,
+            placeholder,
+            extra_headers=BETA_HEADERS,
+            **_followup_params(question, context)
         )
 
-        track_cost(response.usage.input_tokens, response.usage.output_tokens)
+        track_usage(response.usage, model=HAIKU_MODEL)
 
         text = ""
         for block in response.content:
@@ -355,38 +862,151 @@ Answer the follow-up question. Search for additional information if needed."""
         return f"Error: {str(e)}"
 
 
+async def is_followup(client, question, context):
+    """Ask Haiku whether the question builds on the previous research."""
+    try:
+        response = await client.messages.create(
+            model=HAIKU_MODEL,
+            max_tokens=5,
+            messages=[{
+                "role": "user",
+                "content": f"""Previous research topic: {context.get('query', 'Unknown')}
+
+New message: {question}
+
+Is the new message a follow-up about the previous research (FOLLOWUP) or a request for new research (NEW)? Answer with one word."""
+            }]
+        )
+
+        track_usage(response.usage, model=HAIKU_MODEL)
+
+        return "FOLLOWUP" in "".join(b.text for b in response.content if b.type == "text").upper()
+
+    except Exception:
+        return bool(FOLLOWUP_RE.match(question)) or question.count(' ') < 20
+
+
+async def _classify(api_key, query, context):
+    """is_followup on a client of its own, for callers outside an event loop."""
+    async with _build_async_client(api_key) as client:
+        return await is_followup(client, query, context)
+
+
+async def dispatch_query(api_key, query, context=None, use_cache=True, placeholder=None, route=None):
+    """
+    Route a chat query to follow-up or new research, streaming into the placeholder.
+    With earlier research on screen, the follow-up classifier runs alongside
+    the research call, which is cancelled if the query is a follow-up.
+    A route already decided by preflight_query skips the classifier.
+    Returns ('followup', answer_text) or ('research', result).
+    """
+    async with _build_async_client(api_key) as client:
+        research = research_with_web_search(client, query, use_cache=use_cache, placeholder=placeholder)
+        if context is None or route == 'research':
+            return 'research', await research
+        if route == 'followup' or FOLLOWUP_RE.match(query):
+            research.close()  # never started
+            return 'followup', await answer_followup(client, query, context, placeholder)
+
+        research_task = asyncio.create_task(research)
+        if await is_followup(client, query, context):
+            research_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await research_task
+            return 'followup', await answer_followup(client, query, context, placeholder)
+        return 'research', await research_task
+
+
 # ============ UI Components ============
 
-def render_header():
-    st.markdown('''
-    <div class="app-header">
-        <h1>🔬 Research Assistant</h1>
-        <p>AI-powered research with real-time web search</p>
-        <div class="status-bar">
-            <span class="badge active">🌐 Claude Web Search</span>
-            <span class="badge active">📊 Grounded Citations</span>
-        </div>
+HEADER_HTML = '''
+<div class="app-header">
+    <h1>🔬 Research Assistant</h1>
+    <p>AI-powered research with real-time web search</p>
+    <div class="status-bar">
+        <span class="badge active">🌐 Claude Web Search</span>
+        <span class="badge active">📊 Grounded Citations</span>
     </div>
-    ''', unsafe_allow_html=True)
+</div>
+'''
 
+EXAMPLE_PROMPTS = [
+    "Compare pricing for Notion vs Obsidian vs Roam",
+    "What are the top 5 CRM tools for startups in 2025?",
+    "Compare AWS vs GCP vs Azure pricing and features",
+    "Best project management software for remote teams"
+]
+
+
+def render_header():
+    st.markdown(HEADER_HTML, unsafe_allow_html=True)
+
+
+def render_examples():
+    """Example prompts as one form, so they submit together and only rerun on click."""
+    st.markdown("#### Try asking:")
+    with st.form("examples", border=False):
+        cols = st.columns(2)
+        clicked = None
+        for i, ex in enumerate(EXAMPLE_PROMPTS):
+            with cols[i % 2]:
+                if st.form_submit_button(ex, use_container_width=True):
+                    clicked = ex
+    if clicked:
+        queue_research(clicked)
+        st.rerun()
+    if st.session_state.batch_queue:
+        st.caption(f"{len(st.session_state.batch_queue)} queued — run them from the sidebar")
+
+
+def user_message_html(content):
+    return f'<div class="user-msg">{html.escape(content)}</div>'
 
-def render_message(msg, msg_idx=0):
-    if msg['role'] == 'user':
-        st.markdown(f'<div class="user-msg">{msg["content"]}</div>', unsafe_allow_html=True)
-    else:
-        st.markdown(f'<div class="assistant-msg">', unsafe_allow_html=True)
 
-        # Render the text content
-        text = msg.get('content', '')
-        st.markdown(text)
+def _assistant_container(idx):
+    """
+    Container for one answer. Keyed containers (Streamlit >= 1.39) carry an
+    st-key-assistant-msg-* class that the stylesheet targets; older versions get a plain one.
+    """
+    try:
+        return st.container(key=f"assistant-msg-{idx}")
+    except TypeError:
+        return st.container()
 
-        st.markdown('</div>', unsafe_allow_html=True)
 
-        # Render research results if present
+def render_messages(messages):
+    """
+    Render the conversation. Consecutive user messages share one markdown element.
+    Answers are model output grounded on web pages, so each gets its own element
+    with raw HTML off.
+    """
+    run = []
+    for idx, msg in enumerate(messages):
+        if msg['role'] == 'user':
+            run.append(user_message_html(msg['content']))
+            continue
+        if run:
+            st.markdown("\n\n".join(run), unsafe_allow_html=True)
+            run = []
+        with _assistant_container(idx):
+            st.markdown(msg.get('content', ''))
         if msg.get('research'):
-            render_research_results(msg['research'], msg_idx)
+            render_research_results(msg['research'], idx)
+    if run:
+        st.markdown("\n\n".join(run), unsafe_allow_html=True)
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _research_json(research_key, _research):
+    """JSON export of a research result, serialized once rather than on every rerun."""
+    return json.dumps(_research, indent=2, default=str)
+
+
+# Fragments (Streamlit >= 1.33) let a widget rerun just its own block
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda func: func)
 
 
+@_fragment
 def render_research_results(research, msg_idx=0):
     key_prefix = str(msg_idx)
     sources = research.get('sources', [])
@@ -394,18 +1014,19 @@ def render_research_results(research, msg_idx=0):
     # Sources section
     if sources:
         with st.expander(f"📚 Sources ({len(sources)} citations)", expanded=False):
-            for i, s in enumerate(sources):
-                st.markdown(f"""
-                <div class="source-item">
-                    <span class="source-title">[{i+1}] {s.get('title', 'Source')[:60]}</span><br>
-                    <a href="{s.get('url', '#')}" target="_blank" class="source-url">{s.get('url', '')[:80]}...</a>
-                </div>
-                """, unsafe_allow_html=True)
+            # One markdown element for the whole list instead of one per source
+            st.markdown("".join(
+                f'<div class="source-item">'
+                f'<span class="source-title">[{i+1}] {html.escape(s.get("title", "Source")[:60])}</span><br>'
+                f'<a href="{html.escape(s.get("url", "#"))}" target="_blank" class="source-url">{html.escape(s.get("url", "")[:80])}...</a>'
+                f'</div>'
+                for i, s in enumerate(sources)
+            ), unsafe_allow_html=True)
 
     # Export buttons
     col1, col2, col3 = st.columns([1, 1, 2])
     with col1:
-        json_data = json.dumps(research, indent=2, default=str)
+        json_data = _research_json(f"{research.get('query')}|{research.get('timestamp')}", research)
         st.download_button(
             "📥 JSON",
             json_data,
@@ -419,6 +1040,8 @@ def render_research_results(research, msg_idx=0):
     with col3:
         searches = research.get('search_count', 0)
         st.caption(f"🔍 {searches} web searches")
+        if research.get('similar_to'):
+            st.caption(f"♻️ Cached from: {research['similar_to']}")
 
 
 def render_cost_badge():
@@ -430,6 +1053,69 @@ def render_cost_badge():
         ''', unsafe_allow_html=True)
 
 
+def add_research_messages(query, result):
+    """Append a research result (or its error) to the conversation and history."""
+    if result['success']:
+        # Trimmed once here so follow-ups don't re-pay for token counting
+        client = get_client()
+        followup_context = trim_to_tokens(client, result['text']) if client else result['text'][:2000]
+
+        # Add response
+        st.session_state.messages.append({
+            'role': 'assistant',
+            'content': result['text'],
+            'research': {
+                'query': query,
+                'text': result['text'],
+                'sources': result['sources'],
+                'search_count': result.get('search_count', 0),
+                'similar_to': result.get('similar_to'),
+                'followup_context': followup_context,
+                'timestamp': datetime.now().isoformat()
+            }
+        })
+
+        # Add to history
+        save_history(query, st.session_state.messages)
+    else:
+        st.session_state.messages.append({
+            'role': 'assistant',
+            'content': f"I encountered an issue: {result.get('error', 'Unknown error')}. Please try again."
+        })
+
+
+def run_batch_queue(client, combined=False):
+    """Flush queued queries, either as a Message Batch or as one combined call."""
+    queries = list(st.session_state.batch_queue)
+    if combined:
+        with st.spinner(f"🔍 Researching {len(queries)} topics together..."):
+            results = research_with_web_search_combined(client, queries)
+    else:
+        bar = st.progress(0.0, text=f"⏳ Running {len(queries)} queued queries as a batch (this can take a few minutes)...")
+        results = research_with_web_search_batched(
+            client, queries,
+            on_progress=lambda done, total: bar.progress(done / total, text=f"⏳ {done}/{total} queued queries done")
+        )
+        bar.empty()
+
+    add_batch_results({q: results[q] for q in queries if q in results})
+    if len(results) < len(queries):
+        st.toast(f"{len(queries) - len(results)} queued queries are still running — check back from the sidebar")
+    st.session_state.batch_queue = []
+
+
+def add_batch_results(results):
+    for query, result in results.items():
+        st.session_state.messages.append({'role': 'user', 'content': query})
+        add_research_messages(query, result)
+
+
+def queue_research(query):
+    queued = {_query_id(q) for q in st.session_state.batch_queue}
+    if query and _query_id(query) not in queued:
+        st.session_state.batch_queue.append(query)
+
+
 # ============ Main App ============
 
 def main():
@@ -443,37 +1129,65 @@ def main():
     # Sidebar
     with st.sidebar:
         st.markdown("### History")
-        if st.session_state.history:
-            for i, h in enumerate(st.session_state.history[-10:]):
-                if st.button(h['query'][:30] + "...", key=f"hist_{i}", use_container_width=True):
-                    st.session_state.messages = h['messages']
+        history = recent_history()
+        if history:
+            for history_id, history_query in history:
+                if st.button(history_query[:30] + "...", key=f"hist_{history_id}", use_container_width=True):
+                    st.session_state.messages = load_history(history_id) or []
                     st.rerun()
         else:
             st.caption("No research history yet")
 
+        st.divider()
+        st.markdown("### Queue")
+        st.caption("Queued research runs as a batch at half price, but can take minutes.")
+        with st.form("queue_form", clear_on_submit=True):
+            queued = st.text_input("Research topic", label_visibility="collapsed", placeholder="Research topic...")
+            if st.form_submit_button("Queue research", use_container_width=True):
+                queue_research(queued.strip())
+        for q in st.session_state.batch_queue:
+            st.caption(f"• {q[:40]}")
+        if st.session_state.pending_batches:
+            running = sum(len(p['ids']) for p in st.session_state.pending_batches)
+            st.caption(f"{running} queued queries are still running as a batch.")
+            if st.button("Check batch results", use_container_width=True):
+                client = get_client()
+                if client:
+                    add_batch_results(collect_pending_batches(client))
+                    st.rerun()
+                st.error("Please configure your Anthropic API key to continue.")
+        if st.session_state.batch_queue:
+            queued_count = len(st.session_state.batch_queue)
+            run_batch = st.button(f"Run {queued_count} queued", use_container_width=True, type="primary")
+            run_combined = 2 <= queued_count <= COMBINED_MAX_QUERIES and st.button(
+                "Research together", use_container_width=True,
+                help="Answer all queued topics in a single call (fast, cheaper than separate calls)"
+            )
+            if run_batch or run_combined:
+                client = get_client()
+                if client:
+                    run_batch_queue(client, combined=run_combined)
+                    st.rerun()
+                st.error("Please configure your Anthropic API key to continue.")
+
         st.divider()
         st.markdown("### Stats")
         st.caption(f"Session cost: ${st.session_state.session_cost:.4f}")
+        for model_name, model_cost in st.session_state.cost_by_model.items():
+            st.caption(f"• {model_name}: ${model_cost:.4f}")
+        st.toggle("Force refresh", key="force_refresh", help="Skip cached results and search the web again")
+        if st.button("Clear cache", use_container_width=True, help="Forget all cached research and fetched pages"):
+            clear_research_cache()
+            st.toast("Cache cleared")
+        st.number_input("Budget ($)", min_value=0.0, step=1.0, key="budget",
+                        help="Ask for confirmation before a query could take session cost past this")
 
     # Chat history
-    for idx, msg in enumerate(st.session_state.messages):
-        render_message(msg, idx)
+    render_messages(st.session_state.messages)
 
     # Example prompts if empty
     if not st.session_state.messages:
-        st.markdown("#### Try asking:")
-        examples = [
-            "Compare pricing for Notion vs Obsidian vs Roam",
-            "What are the top 5 CRM tools for startups in 2025?",
-            "Compare AWS vs GCP vs Azure pricing and features",
-            "Best project management software for remote teams"
-        ]
-        cols = st.columns(2)
-        for i, ex in enumerate(examples):
-            with cols[i % 2]:
-                if st.button(ex, key=f"ex_{i}", use_container_width=True):
-                    st.session_state.pending_query = ex
-                    st.rerun()
+        render_examples()
 
     # Cost badge
     render_cost_badge()
@@ -481,70 +1195,67 @@ def main():
     # Chat input
     query = st.chat_input("Ask me to research anything...")
 
-    # Check for pending query
-    if hasattr(st.session_state, 'pending_query') and st.session_state.pending_query:
-        query = st.session_state.pending_query
-        st.session_state.pending_query = None
-
-    if query:
-        # Add user message
-        st.session_state.messages.append({'role': 'user', 'content': query})
-        st.markdown(f'<div class="user-msg">{query}</div>', unsafe_allow_html=True)
-
-        client = get_client()
-        if not client:
-            st.session_state.messages.append({
-                'role': 'assistant',
-                'content': "Please configure your Anthropic API key to continue."
-            })
+    # Over-budget query waiting for confirmation
+    confirmed = False
+    if st.session_state.over_budget_query:
+        st.warning(f"Running \"{st.session_state.over_budget_query[:60]}\" could take this session past "
+                   f"your ${st.session_state.budget:.2f} budget. Run it anyway?")
+        col1, col2 = st.columns(2)
+        if col1.button("Run anyway", use_container_width=True, type="primary"):
+            query = st.session_state.over_budget_query
+            confirmed = True
+            st.session_state.over_budget_query = None
+        elif col2.button("Cancel", use_container_width=True):
+            st.session_state.over_budget_query = None
             st.rerun()
 
+    if query:
         # Check if follow-up question
         current_research = None
-        for msg in reversed(st.session_state.messages[:-1]):
+        for msg in reversed(st.session_state.messages):
             if msg.get('research'):
                 current_research = msg['research']
                 break
 
-        if current_research and len(query.split()) < 20:
-            # Answer follow-up
-            with st.spinner("Researching..."):
-                answer = answer_followup(client, query, current_research)
-            st.session_state.messages.append({
-                'role': 'assistant',
-                'content': answer
-            })
-            st.rerun()
-
-        # New research
-        with st.spinner("🔍 Searching the web and analyzing results..."):
-            result = research_with_web_search(client, query)
+        client = get_client()
+        route = None
+        cached = not st.session_state.force_refresh and get_cached_research(query)
+        if client and not confirmed and not cached:
+            route, projected = preflight_query(client, get_secret('ANTHROPIC_API_KEY'), query, current_research)
+            if over_budget(projected):
+                st.session_state.over_budget_query = query
+                st.rerun()
 
-        if result['success']:
-            # Add to history
-            st.session_state.history.append({
-                'query': query,
-                'messages': st.session_state.messages.copy(),
-                'timestamp': datetime.now().isoformat()
-            })
+        # Add user message
+        st.session_state.messages.append({'role': 'user', 'content': query})
+        st.markdown(user_message_html(query), unsafe_allow_html=True)
 
-            # Add response
+        api_key = get_secret('ANTHROPIC_API_KEY')
+        if not api_key:
             st.session_state.messages.append({
                 'role': 'assistant',
-                'content': result['text'],
-                'research': {
-                    'query': query,
-                    'text': result['text'],
-                    'sources': result['sources'],
-                    'search_count': result.get('search_count', 0),
-                    'timestamp': datetime.now().isoformat()
-                }
+                'content': "Please configure your Anthropic API key to continue."
             })
-        else:
+            st.rerun()
+
+        # Streamed text replaces the thinking line as soon as it arrives
+        placeholder = st.empty()
+        placeholder.markdown('<div class="thinking">🔍 Searching the web and analyzing results...</div>', unsafe_allow_html=True)
+        kind, result = asyncio.run(dispatch_query(
+            api_key, query, current_research,
+            use_cache=not st.session_state.force_refresh,
+            placeholder=placeholder,
+            route=route
+        ))
+
+        if kind == 'followup':
             st.session_state.messages.append({
                 'role': 'assistant',
-                'content': f"I encountered an issue: {result.get('error', 'Unknown error')}. Please try again."
+                'content': result
             })
+            st.rerun()
+
+        add_research_messages(query, result)
 
         st.rerun()
 
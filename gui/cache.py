@@ -0,0 +1,135 @@
+"""
+Persistent Response Cache
+
+SQLite-backed key/value store for LLM responses and fetched pages:
+1. Keys are a BLAKE2b hash of the call's inputs
+2. Values are JSON, zlib-compressed (fetched HTML shrinks 5-10x)
+3. Entries expire after a TTL
+
+Re-running an identical research query becomes a local lookup instead of
+several paid API calls.
+"""
+
+import os
+import json
+import zlib
+import time
+import sqlite3
+import hashlib
+import inspect
+import functools
+import threading
+from contextlib import closing
+from typing import Any, Callable, Optional
+
+
+CACHE_PATH = os.environ.get(
+    "WEB_RESEARCH_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "web-research", "cache.sqlite")
+)
+DEFAULT_TTL = 86400  # 1 day
+
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def _connect() -> sqlite3.Connection:
+    """Open a connection, creating the database and table on first use."""
+    global _initialized
+    if not _initialized:
+        with _init_lock:
+            if not _initialized:
+                os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+                with closing(sqlite3.connect(CACHE_PATH)) as conn, conn:
+                    conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB, ts REAL)")
+                _initialized = True
+    return sqlite3.connect(CACHE_PATH, timeout=5)
+
+
+def make_key(*parts: Any) -> str:
+    """Stable hash of any JSON-serializable inputs. Not a security boundary, so a fast 128-bit BLAKE2b."""
+    payload = json.dumps(parts, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+def get(key: str, ttl: float = DEFAULT_TTL) -> Optional[Any]:
+    """Return the cached value, or None if missing, expired or unreadable."""
+    try:
+        with closing(_connect()) as conn:
+            row = conn.execute("SELECT value, ts FROM kv WHERE key = ?", (key,)).fetchone()
+        if row is None or time.time() - row[1] > ttl:
+            return None
+        return json.loads(zlib.decompress(row[0]))
+    except (sqlite3.Error, zlib.error, ValueError):
+        return None
+
+
+def put(key: str, value: Any) -> None:
+    """Store a JSON-serializable value. Cache failures never break the caller."""
+    try:
+        blob = zlib.compress(json.dumps(value, default=str).encode())
+        with closing(_connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value, ts) VALUES (?, ?, ?)",
+                (key, blob, time.time())
+            )
+    except (sqlite3.Error, TypeError, ValueError):
+        pass
+
+
+def clear() -> None:
+    """Drop every entry."""
+    try:
+        with closing(_connect()) as conn, conn:
+            conn.execute("DELETE FROM kv")
+    except sqlite3.Error:
+        pass
+
+
+def disk_cache(
+    ttl: float = DEFAULT_TTL,
+    key: Optional[Callable[..., Any]] = None,
+    cache_if: Callable[[Any], bool] = lambda result: result is not None
+):
+    """
+    Cache a function's JSON-serializable result on disk.
+
+    Args:
+        ttl: Seconds before an entry is recomputed
+        key: Called with the function's arguments to pick the inputs to hash
+             (default: all arguments)
+        cache_if: Only results passing this check are stored
+
+    Works on plain and async functions.
+    """
+    def decorator(func):
+        def cache_key(args, kwargs):
+            inputs = key(*args, **kwargs) if key else (args, kwargs)
+            return make_key(func.__module__, func.__qualname__, inputs)
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                k = cache_key(args, kwargs)
+                cached = get(k, ttl)
+                if cached is not None:
+                    return cached
+                result = await func(*args, **kwargs)
+                if cache_if(result):
+                    put(k, result)
+                return result
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            k = cache_key(args, kwargs)
+            cached = get(k, ttl)
+            if cached is not None:
+                return cached
+            result = func(*args, **kwargs)
+            if cache_if(result):
+                put(k, result)
+            return result
+        return wrapper
+
+    return decorator
@@ -9,9 +9,17 @@ Implements a layered extraction approach:
 This reduces costs by 60%+ by only using LLM when simpler methods fail.
 """
 
+import os
 import re
+import html
 import json
-from typing import Any, Optional
+import atexit
+import asyncio
+import threading
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Optional, Union
 from bs4 import BeautifulSoup
 try:
     from pydantic import BaseModel, Field, field_validator, ValidationError
@@ -87,6 +95,15 @@ class ValidationResult(BaseModel):
     confidence_score: float = Field(default=0.5, ge=0, le=1)
 
 
+def _trusted(model_cls, **fields):
+    """
+    Build a model from values this module computed itself, skipping validation.
+    Anything from outside (LLM output, user input) should go through the normal constructor.
+    """
+    construct = getattr(model_cls, 'model_construct', None) or model_cls.construct
+    return construct(**fields)
+
+
 # ============ Regex Patterns for Common Data Types ============
 
 REGEX_PATTERNS = {
@@ -117,6 +134,15 @@ REGEX_PATTERNS = {
     ],
 }
 
+# Compiled once at import; every extractor reuses them
+COMPILED_PATTERNS = {
+    field: [re.compile(p, re.IGNORECASE) for p in patterns]
+    for field, patterns in REGEX_PATTERNS.items()
+}
+
+# Fields whose regex strategy returns every distinct match instead of the first
+MULTI_VALUE_FIELDS = frozenset({'features', 'email', 'phone'})
+
 
 # ============ CSS Selectors for Common Page Structures ============
 
@@ -181,8 +207,16 @@ class MultiStrategyExtractor:
                 self.soup = BeautifulSoup(html_content, 'html.parser')
         else:
             self.soup = None
+        self._text = None
         self.extraction_log = []
 
+    @property
+    def text(self) -> str:
+        """Visible page text, computed on first use. Walking the whole tree per field was the hot spot."""
+        if self._text is None:
+            self._text = self.soup.get_text() if self.soup else (self.html or '')
+        return self._text
+
     def extract_with_css(self, field_name: str) -> tuple[Optional[str], float]:
         """Try to extract using CSS selectors. Returns (value, confidence)."""
         if not self.soup:
@@ -222,22 +256,26 @@ class MultiStrategyExtractor:
     def extract_with_regex(self, field_name: str, text: Optional[str] = None) -> tuple[Optional[Any], float]:
         """Try to extract using regex patterns. Returns (value, confidence)."""
         if text is None:
-            text = self.soup.get_text() if self.soup else self.html
+            text = self.text
 
         if not text:
             return None, 0
 
-        patterns = REGEX_PATTERNS.get(field_name, [])
+        patterns = COMPILED_PATTERNS.get(field_name, [])
+        multi = field_name in MULTI_VALUE_FIELDS
 
         for pattern in patterns:
             try:
-                matches = re.findall(pattern, text, re.IGNORECASE)
-                if matches:
-                    self.extraction_log.append(f"Regex: Found {field_name} with pattern {pattern[:30]}...")
-                    # Return first match for single values, all matches for lists
-                    if field_name in ['features', 'email', 'phone']:
-                        return list(set(matches)), 0.75
-                    return matches[0], 0.75
+                # Return first match for single values, all matches for lists
+                if multi:
+                    matches = pattern.findall(text)
+                    value = list(set(matches)) if matches else None
+                else:
+                    match = pattern.search(text)
+                    value = match.group(0) if match else None
+                if value:
+                    self.extraction_log.append(f"Regex: Found {field_name} with pattern {pattern.pattern[:30]}...")
+                    return value, 0.75
             except Exception:
                 continue
 
@@ -279,14 +317,15 @@ class MultiStrategyExtractor:
 
         for field_name, field_desc in schema.items():
             # Determine field type from description
+            name = field_name.lower()
             field_type = 'text'
-            if 'price' in field_name.lower() or 'cost' in field_name.lower():
+            if 'price' in name or 'cost' in name:
                 field_type = 'price'
-            elif 'feature' in field_name.lower() or isinstance(field_desc, list):
+            elif 'feature' in name or isinstance(field_desc, list):
                 field_type = 'list'
-            elif 'email' in field_name.lower():
+            elif 'email' in name:
                 field_type = 'email'
-            elif 'date' in field_name.lower():
+            elif 'date' in name:
                 field_type = 'date'
 
             value, confidence, method = self.extract_field(field_name, field_type)
@@ -308,7 +347,8 @@ class MultiStrategyExtractor:
         else:
             primary_method = 'none'
 
-        return ExtractedData(
+        return _trusted(
+            ExtractedData,
             data=extracted,
             source_url=self.url,
             extraction_method=primary_method,
@@ -393,7 +433,8 @@ def validate_extracted_data(data: dict, schema: dict) -> ValidationResult:
 
     confidence = max(0, (valid_fields / total_fields) - error_penalty - warning_penalty) if total_fields > 0 else 0
 
-    return ValidationResult(
+    return _trusted(
+        ValidationResult,
         is_valid=len(errors) == 0,
         errors=errors,
         warnings=warnings,
@@ -423,23 +464,69 @@ def validate_price_string(price_str: str) -> Optional[float]:
 
 # ============ Content Fetching ============
 
-async def fetch_html(url: str, timeout: int = 30) -> tuple[Optional[str], Optional[str]]:
+FETCH_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.9',
+}
+FETCH_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=60)
+# Per-phase limits: a dead host fails on connect in seconds instead of holding a worker for 30s
+FETCH_TIMEOUT = httpx.Timeout(connect=3.0, read=15.0, write=5.0, pool=2.0)
+
+_sync_client: Optional[httpx.Client] = None
+_sync_client_lock = threading.Lock()
+
+
+def get_sync_client() -> httpx.Client:
+    """Shared client for fetch_html_sync, so repeat fetches reuse keep-alive connections."""
+    global _sync_client
+    with _sync_client_lock:
+        if _sync_client is None:
+            _sync_client = httpx.Client(
+                transport=httpx.HTTPTransport(http2=True, limits=FETCH_LIMITS, retries=1),
+                follow_redirects=True,
+                headers=FETCH_HEADERS,
+                timeout=FETCH_TIMEOUT
+            )
+            atexit.register(_sync_client.close)
+    return _sync_client
+
+
+def _decode(body: bytes, response: httpx.Response) -> str:
+    return body.decode(response.encoding or 'utf-8', errors='replace')
+
+
+async def fetch_html(
+    url: str,
+    timeout: Union[float, httpx.Timeout] = FETCH_TIMEOUT,
+    client: Optional[httpx.AsyncClient] = None,
+    max_bytes: Optional[int] = None
+) -> tuple[Optional[str], Optional[str]]:
     """
     Fetch HTML content from URL.
+    Pass a shared client to reuse its connection pool across many fetches.
+    With max_bytes, stop reading the body after that many bytes.
     Returns (html_content, error_message).
     """
     if not validate_url(url):
         return None, "Invalid URL format"
 
     try:
-        async with httpx.AsyncClient(follow_redirects=True, timeout=timeout) as client:
-            response = await client.get(url, headers={
-                'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'en-US,en;q=0.9',
-            })
+        async with contextlib.AsyncExitStack() as stack:
+            if client is None:
+                client = await stack.enter_async_context(httpx.AsyncClient(
+                    transport=httpx.AsyncHTTPTransport(retries=1), follow_redirects=True
+                ))
+            response = await stack.enter_async_context(client.stream(
+                'GET', url, timeout=timeout, follow_redirects=True, headers=FETCH_HEADERS
+            ))
             response.raise_for_status()
-            return response.text, None
+            body = bytearray()
+            async for chunk in response.aiter_bytes(65536):
+                body += chunk
+                if max_bytes and len(body) >= max_bytes:
+                    break
+            return _decode(bytes(body[:max_bytes] if max_bytes else body), response), None
     except httpx.TimeoutException:
         return None, "Request timed out"
     except httpx.HTTPStatusError as e:
@@ -448,7 +535,11 @@ async def fetch_html(url: str, timeout: int = 30) -> tuple[Optional[str], Option
         return None, str(e)
 
 
-def fetch_html_sync(url: str, timeout: int = 30) -> tuple[Optional[str], Optional[str]]:
+def fetch_html_sync(
+    url: str,
+    timeout: Union[float, httpx.Timeout] = FETCH_TIMEOUT,
+    max_bytes: Optional[int] = None
+) -> tuple[Optional[str], Optional[str]]:
     """
     Synchronous version of fetch_html.
     Returns (html_content, error_message).
@@ -457,14 +548,14 @@ def fetch_html_sync(url: str, timeout: int = 30) -> tuple[Optional[str], Optiona
         return None, "Invalid URL format"
 
     try:
-        with httpx.Client(follow_redirects=True, timeout=timeout) as client:
-            response = client.get(url, headers={
-                'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'en-US,en;q=0.9',
-            })
+        with get_sync_client().stream('GET', url, timeout=timeout) as response:
             response.raise_for_status()
-            return response.text, None
+            body = bytearray()
+            for chunk in response.iter_bytes(65536):
+                body += chunk
+                if max_bytes and len(body) >= max_bytes:
+                    break
+            return _decode(bytes(body[:max_bytes] if max_bytes else body), response), None
     except httpx.TimeoutException:
         return None, "Request timed out"
     except httpx.HTTPStatusError as e:
@@ -473,6 +564,90 @@ def fetch_html_sync(url: str, timeout: int = 30) -> tuple[Optional[str], Optiona
         return None, str(e)
 
 
+# ============ Text Cleanup ============
+
+BOILERPLATE_TAGS = ('script', 'style', 'noscript', 'svg', 'nav', 'header', 'footer', 'aside')
+# The lookahead keeps custom elements like <header-bar> from opening a <header> match
+_BOILERPLATE_OPEN_RE = re.compile(
+    r'<(%s)(?=[\s>/])|<!--' % '|'.join(BOILERPLATE_TAGS),
+    re.IGNORECASE
+)
+_BOILERPLATE_CLOSE_RE = {tag: re.compile(rf'</{tag}\s*>', re.IGNORECASE) for tag in BOILERPLATE_TAGS}
+_BOILERPLATE_CLOSE_RE[None] = re.compile(r'-->')
+_TAG_RE = re.compile(r'<[^<>]+>')
+_SPACE_RE = re.compile(r'\s+')
+
+
+def _strip_boilerplate(html_content: str) -> str:
+    """
+    Replace boilerplate elements and comments with a space.
+    The next closer of each kind is remembered, and a kind with none left is
+    never searched for again, so a page full of unclosed tags stays linear.
+    """
+    parts = []
+    closers = {}  # kind -> (start, end) of its next closer, or None once there are none
+    pos = 0
+    while (m := _BOILERPLATE_OPEN_RE.search(html_content, pos)):
+        kind = m.group(1) and m.group(1).lower()
+        closer = closers.get(kind, ())
+        if closer == () or (closer is not None and closer[0] < m.end()):
+            found = _BOILERPLATE_CLOSE_RE[kind].search(html_content, m.end())
+            closer = closers[kind] = found.span() if found else None
+        if closer is None:
+            # Never closed: keep scanning after the opening tag, _TAG_RE drops it later
+            parts.append(html_content[pos:m.end()])
+            pos = m.end()
+            continue
+        parts.append(html_content[pos:m.start()])
+        parts.append(' ')
+        pos = closer[1]
+    parts.append(html_content[pos:])
+    return ''.join(parts)
+
+
+def html_to_text(html_content: str) -> str:
+    """
+    Visible prose from raw HTML, for LLM prompts.
+    Drops scripts, styles and page chrome, then tags, and collapses whitespace,
+    so a fixed character budget carries content instead of markup.
+    """
+    text = _strip_boilerplate(html_content)
+    text = _TAG_RE.sub(' ', text)
+    return _SPACE_RE.sub(' ', html.unescape(text)).strip()
+
+
+# ============ Parallel Extraction ============
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _extract_in_worker(html_content: str, url: str, schema: dict) -> ExtractedData:
+    return MultiStrategyExtractor(html_content, url).extract_all(schema)
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """
+    Process pool for HTML parsing, created on first use.
+    Parsing is CPU-bound, so threads would serialize on the GIL.
+    """
+    global _process_pool
+    if _process_pool is None:
+        # Spawn, not fork: callers already have fetch threads that may hold httpx, h2 or
+        # sqlite locks, and a forked child would inherit them held. Spawned workers
+        # re-import the caller's __main__, so scripts must keep their work under a __main__ guard.
+        _process_pool = ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _process_pool
+
+
+async def extract_async(html_content: str, url: str, schema: dict) -> ExtractedData:
+    """Run MultiStrategyExtractor.extract_all in the process pool without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_process_pool(), _extract_in_worker, html_content, url, schema)
+
+
 # ============ Extraction Pipeline ============
 
 def extract_with_fallback(
@@ -536,8 +711,9 @@ def extract_with_fallback(
             missing_schema = {k: schema[k] for k in result.fields_missing}
             llm_result = llm_extractor(url, missing_schema)
 
-            # Merge results
-            for field, value in llm_result.items():
+            # Merge results: walk the fields we asked for, not whatever keys came back
+            for field in missing_schema:
+                value = llm_result.get(field)
                 if value is not None and field not in result.data:
                     result.data[field] = value
                     result.fields_extracted.append(field)
@@ -0,0 +1,17 @@
+import pytest
+import streamlit as st
+
+
+class SessionState(dict):
+    """Stand-in for st.session_state outside a running app: a dict with attribute access."""
+    __getattr__ = dict.__getitem__
+    __setattr__ = dict.__setitem__
+
+
+@pytest.fixture
+def session_state(monkeypatch):
+    import app
+    state = SessionState()
+    monkeypatch.setattr(st, "session_state", state)
+    app.init_state()
+    return state
@@ -0,0 +1,122 @@
+"""Tests for app.py logic that runs without the Streamlit server or the API."""
+
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+
+def _text(text):
+    return SimpleNamespace(type="text", text=text)
+
+
+def _response(*blocks):
+    return SimpleNamespace(content=list(blocks), usage=SimpleNamespace(input_tokens=10, output_tokens=20))
+
+
+def test_combined_answers_split_across_text_blocks():
+    # A web search between answers starts a new text block right at the delimiter
+    response = _response(
+        _text("===ANSWER 1===\nNotion costs $10."),
+        SimpleNamespace(type="web_search_tool_result", content=[]),
+        _text("===ANSWER 2===\nObsidian is free."),
+    )
+    combined = app._parse_research_response(response, block_separator="\n")
+    assert app._split_answers(combined['text']) == {1: "Notion costs $10.", 2: "Obsidian is free."}
+
+
+def test_research_text_blocks_join_without_separator_by_default():
+    response = _response(_text("Notion costs "), _text("$10."))
+    assert app._parse_research_response(response)['text'] == "Notion costs $10."
+
+
+def _counting_client(tokens=1000):
+    count = lambda **params: SimpleNamespace(input_tokens=tokens)
+    return SimpleNamespace(messages=SimpleNamespace(count_tokens=count))
+
+
+def _classifier(answer, calls):
+    async def classify(api_key, query, context):
+        calls.append(query)
+        return answer
+    return classify
+
+
+CONTEXT = {'query': "Compare Notion vs Obsidian", 'text': "Notion costs $10."}
+
+
+def test_preflight_prices_followups_at_the_followup_model(session_state, monkeypatch):
+    client = _counting_client()
+    research = app.estimate_research_cost(client, "is it cheaper for teams?")
+    followup = app.estimate_followup_cost(client, "is it cheaper for teams?", CONTEXT)
+    assert followup < research
+    session_state.budget = (research + followup) / 2
+    calls = []
+    monkeypatch.setattr(app, "_classify", _classifier(True, calls))
+
+    route, projected = app.preflight_query(client, "key", "is it cheaper for teams?", CONTEXT)
+    assert (route, projected) == ('followup', followup)
+    assert not app.over_budget(projected)
+    assert calls == ["is it cheaper for teams?"]
+
+
+def test_preflight_keeps_research_price_for_new_research(session_state, monkeypatch):
+    client = _counting_client()
+    research = app.estimate_research_cost(client, "best GPUs for training")
+    session_state.budget = research / 2
+    monkeypatch.setattr(app, "_classify", _classifier(False, []))
+
+    assert app.preflight_query(client, "key", "best GPUs for training", CONTEXT) == ('research', research)
+
+
+def test_preflight_only_routes_near_the_budget(session_state, monkeypatch):
+    calls = []
+    monkeypatch.setattr(app, "_classify", _classifier(True, calls))
+    route, projected = app.preflight_query(_counting_client(), "key", "is it cheaper for teams?", CONTEXT)
+    assert route is None and not app.over_budget(projected)
+    assert calls == []
+
+
+def test_followup_regex_only_matches_anaphoric_openers():
+    for question in ["What about Roam?", "and the free tier?", "Tell me more", "expand on that", "why is that"]:
+        assert app.FOLLOWUP_RE.match(question), question
+    for question in ["why do GPUs throttle?", "and now for something new", "more GPU benchmarks",
+                     "can you research CRM tools?"]:
+        assert not app.FOLLOWUP_RE.match(question), question
+
+
+def test_model_rates_for_a_listed_model():
+    assert app.model_rates("claude-sonnet-4-20250514") == (3.0, 15.0)
+    assert app.compute_cost(1_000_000, 1_000_000, model="claude-3-5-haiku-latest") == 4.8
+
+
+def test_model_rates_fall_back_by_family_then_to_the_default_model():
+    assert app.model_rates("claude-haiku-4-5-20251001") == app.model_rates("claude-3-5-haiku-latest")
+    assert app.model_rates("some-future-model") == app.model_rates(app.MODEL)
+
+
+@pytest.fixture
+def research_cache():
+    app._research_cache.clear()
+    yield
+    app._research_cache.clear()
+
+
+def test_reordered_query_reuses_earlier_research(session_state, research_cache):
+    app.store_research("Compare pricing for Notion vs Obsidian", {'success': True, 'text': "answer"}, persist=False)
+
+    hit = app._similar_research("Obsidian vs Notion pricing comparison", 5)
+    assert hit['text'] == "answer" and hit['cached']
+    assert hit['similar_to'] == "Compare pricing for Notion vs Obsidian"
+
+    assert app._similar_research("Compare pricing for Notion vs Obsidian in 2023", 5) is None
+    assert app._similar_research("best GPUs for training", 5) is None
+    assert app._similar_research("Obsidian vs Notion pricing comparison", 3) is None
+
+
+def test_similar_research_hides_other_sessions_wording(session_state, research_cache):
+    app.store_research("Compare pricing for Notion vs Obsidian", {'success': True, 'text': "answer"}, persist=False)
+    session_state.session_id = "someone-else"
+    hit = app._similar_research("Obsidian vs Notion pricing comparison", 5)
+    assert hit['text'] == "answer" and hit['similar_to'] is None
@@ -0,0 +1,69 @@
+"""Tests for the SQLite response cache."""
+
+import asyncio
+
+import pytest
+
+import cache
+
+
+@pytest.fixture(autouse=True)
+def tmp_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_PATH", str(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(cache, "_initialized", False)
+
+
+def test_put_get_round_trip():
+    cache.put("k", {"a": [1, 2], "b": "text"})
+    assert cache.get("k") == {"a": [1, 2], "b": "text"}
+    assert cache.get("missing") is None
+
+
+def test_expired_entries_are_misses(monkeypatch):
+    cache.put("k", "value")
+    now = cache.time.time()
+    monkeypatch.setattr(cache.time, "time", lambda: now + 61)
+    assert cache.get("k", ttl=60) is None
+    assert cache.get("k", ttl=120) == "value"
+
+
+def test_make_key_is_stable():
+    assert cache.make_key("research", {"b": 1, "a": 2}) == cache.make_key("research", {"a": 2, "b": 1})
+    assert cache.make_key("research", "x") != cache.make_key("research", "y")
+    assert len(cache.make_key("x")) == 32
+
+
+def test_clear_drops_everything():
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.clear()
+    assert cache.get("a") is None and cache.get("b") is None
+
+
+def test_disk_cache_skips_results_rejected_by_cache_if():
+    calls = []
+
+    @cache.disk_cache(cache_if=lambda result: result["ok"])
+    def fetch(x):
+        calls.append(x)
+        return {"ok": x > 0}
+
+    fetch(-1)
+    fetch(-1)
+    fetch(1)
+    fetch(1)
+    assert calls == [-1, -1, 1]
+
+
+def test_disk_cache_async_and_custom_key():
+    calls = []
+
+    @cache.disk_cache(key=lambda client, url: url)
+    async def fetch(client, url):
+        calls.append(url)
+        return url.upper()
+
+    assert asyncio.run(fetch(object(), "a")) == "A"
+    # A different client object must not change the key
+    assert asyncio.run(fetch(object(), "a")) == "A"
+    assert calls == ["a"]
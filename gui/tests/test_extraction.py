@@ -0,0 +1,46 @@
+"""Tests for extraction.py helpers that run without network access."""
+
+import time
+
+from extraction import extract_with_fallback, html_to_text
+
+
+def test_html_to_text_drops_boilerplate_and_comments():
+    page = (
+        '<p>Hi</p><script>var a = 1;</script><NAV class="x">menu</nav >'
+        '<!-- note --><p>ok</p><footer>links</footer>'
+    )
+    assert html_to_text(page) == 'Hi ok'
+
+
+def test_html_to_text_keeps_custom_elements():
+    page = '<header-bar>Brand</header-bar><p>body</p><header>top</header><p>end</p>'
+    assert html_to_text(page) == 'Brand body end'
+
+
+def test_html_to_text_unclosed_tags_stay_linear():
+    page = '<p>start</p>' + '<nav><p>item</p>' * 2000 + 'body text ' * 20000
+    started = time.perf_counter()
+    text = html_to_text(page)
+    assert time.perf_counter() - started < 1.0
+    assert text.startswith('start item') and text.endswith('body text')
+
+
+def test_fallback_fills_only_the_missing_fields():
+    page = '<html><title>Acme</title><body><p>Price: $10/month</p></body></html>'
+    asked = []
+
+    def llm(url, schema):
+        asked.append(dict(schema))
+        # Unrequested keys and a null for a requested field must not leak into the result
+        return {'founder': 'Ada', 'extra': 'x', 'price': None}
+
+    result = extract_with_fallback(
+        'https://acme.com', {'price': 'Price', 'founder': 'Founder name'}, page, llm, use_llm_threshold=0.9
+    )
+    assert asked == [{'founder': 'Founder name'}]
+    assert result.data['founder'] == 'Ada'
+    assert result.data['price']['amount'] == 10.0
+    assert 'extra' not in result.data
+    assert result.fields_missing == []
+    assert result.extraction_method == 'hybrid'
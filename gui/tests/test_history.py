@@ -0,0 +1,67 @@
+"""Tests for the SQLite research history and its chains of message deltas."""
+
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timedelta
+
+import pytest
+
+import app
+
+
+@pytest.fixture(autouse=True)
+def tmp_history(tmp_path, monkeypatch, session_state):
+    monkeypatch.setattr(app, "HISTORY_DB", str(tmp_path / "history.db"))
+    app._history_db.clear()
+    yield
+    app._history_db.clear()
+
+
+def _messages(*texts):
+    return [{'role': 'user' if i % 2 == 0 else 'assistant', 'content': t} for i, t in enumerate(texts)]
+
+
+def test_load_rebuilds_the_chain(session_state):
+    messages = _messages("q1", "a1")
+    app.save_history("q1", messages)
+    messages += _messages("q2", "a2")
+    app.save_history("q2", messages)
+    head = session_state.history_head
+
+    session_state.history_head, session_state.history_saved = None, 0
+    assert app.load_history(head) == messages
+    assert app.recent_history() == [(head, "q2"), (head - 1, "q1")]
+
+
+def test_saving_after_loading_an_older_entry_branches(session_state):
+    app.save_history("q1", _messages("q1", "a1"))
+    first = session_state.history_head
+    app.save_history("q2", _messages("q1", "a1", "q2", "a2"))
+    second = session_state.history_head
+
+    branched = app.load_history(first) + _messages("q3", "a3")
+    app.save_history("q3", branched)
+
+    assert app.load_history(session_state.history_head) == branched
+    assert app.load_history(second) == _messages("q1", "a1", "q2", "a2")
+
+
+def test_other_sessions_history_is_not_readable(session_state):
+    app.save_history("q1", _messages("q1", "a1"))
+    head = session_state.history_head
+    session_state.session_id = "someone-else"
+    assert app.load_history(head) is None
+    assert app.recent_history() == []
+
+
+def test_prune_drops_whole_sessions_by_their_latest_row():
+    old = (datetime.now() - timedelta(days=app.HISTORY_RETENTION_DAYS + 1)).isoformat()
+    recent = datetime.now().isoformat()
+    rows = [("stale", old), ("active", old), ("active", recent)]
+    with closing(sqlite3.connect(app._history_db())) as conn, conn:
+        conn.executemany(
+            "INSERT INTO history (session_id, query, timestamp, messages_json) VALUES (?, 'q', ?, '[]')", rows
+        )
+        app._prune_history(conn)
+        remaining = conn.execute("SELECT session_id, timestamp FROM history ORDER BY id").fetchall()
+    assert remaining == [("active", old), ("active", recent)]
@@ -0,0 +1,73 @@
+"""Tests for the test_search.py pipeline helpers, with the Claude calls faked."""
+
+import asyncio
+
+import pytest
+
+import test_search as pipeline
+
+
+def test_chunk_items_splits_at_the_content_budget():
+    budget = pipeline.MAX_BATCH_CHARS
+    items = [("a", "x" * (budget - 10)), ("b", "x" * 10), ("c", "x"), ("d", "")]
+    assert pipeline._chunk_items(items) == [items[:2], items[2:]]
+    # A source bigger than the budget still gets a chunk of its own
+    assert pipeline._chunk_items([("big", "x" * (budget + 1)), ("e", "x")]) == [[("big", "x" * (budget + 1))], [("e", "x")]]
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """Record extract_data_batch calls; replies come from the test's reply function."""
+    calls = []
+    monkeypatch.setattr(pipeline, "BATCH_RETRY_SECONDS", 0)
+
+    def install(reply):
+        def fake_batch(items, schema_json, topic):
+            calls.append([url for url, _ in items])
+            return reply(items, len(calls))
+        monkeypatch.setattr(pipeline, "extract_data_batch", fake_batch)
+        return calls
+    return install
+
+
+def _ok(url):
+    return {'_url': url, '_ok': True}
+
+
+def test_malformed_rows_are_retried_alone(calls):
+    def reply(items, n):
+        if len(items) > 1:
+            return [_ok(items[0][0])] + [{'_url': url, '_error': 'missing from batch response', '_ok': False}
+                                         for url, _ in items[1:]]
+        return [_ok(items[0][0])]
+    log = calls(reply)
+
+    results = asyncio.run(pipeline.extract_llm([("a", "x"), ("b", "x"), ("c", "x")], "{}", "topic"))
+    assert log == [["a", "b", "c"], ["b"], ["c"]]
+    assert all(r['_ok'] for r in results)
+
+
+def test_failed_calls_back_off_instead_of_fanning_out(calls):
+    def reply(items, n):
+        if n == 1:
+            return [{'_url': url, '_error': '429', '_ok': False, '_call_failed': True} for url, _ in items]
+        return [_ok(url) for url, _ in items]
+    log = calls(reply)
+
+    results = asyncio.run(pipeline.extract_llm([("a", "x"), ("b", "x")], "{}", "topic"))
+    assert log == [["a", "b"], ["a", "b"]]
+    assert sorted(r['_url'] for r in results if r['_ok']) == ["a", "b"]
+
+
+def test_failed_retry_is_not_split_into_single_calls(calls):
+    log = calls(lambda items, n: [{'_url': url, '_error': '429', '_ok': False, '_call_failed': True}
+                                  for url, _ in items])
+    results = asyncio.run(pipeline.extract_llm([("a", "x"), ("b", "x")], "{}", "topic"))
+    assert log == [["a", "b"], ["a", "b"]]
+    assert not any(r['_ok'] for r in results)
+
+
+def test_complete_fields_only_reports_finished_values():
+    buf = '{"summary": "Notion is \\"cheap\\".", "findings": ["Free tier", "Sync costs $4'
+    assert pipeline._complete_fields(buf) == ('Notion is "cheap".', ["Free tier"])
+    assert pipeline._complete_fields('{"summary": "Not yet') == (None, [])
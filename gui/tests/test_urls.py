@@ -0,0 +1,23 @@
+"""Tests for canonical_url, the dedupe key shared by the app and test_search."""
+
+from urls import canonical_url
+
+
+def test_drops_utm_and_tracking_params():
+    assert canonical_url("https://ex.com/p?utm_source=x&UTM_Medium=y&fbclid=1&gclid=2&ref=hn") == "https://ex.com/p"
+
+
+def test_drops_fragment_and_trailing_slash():
+    assert canonical_url("https://ex.com/pricing/#plans") == "https://ex.com/pricing"
+
+
+def test_lowercases_host_only():
+    assert canonical_url("https://Ex.COM/Pricing") == "https://ex.com/Pricing"
+
+
+def test_keeps_meaningful_query_params_in_order():
+    assert canonical_url("https://ex.com/search?q=crm&utm_campaign=z&page=2") == "https://ex.com/search?q=crm&page=2"
+
+
+def test_variants_collapse_to_one_key():
+    assert canonical_url("https://EX.com/a/?utm_source=x#top") == canonical_url("https://ex.com/a")
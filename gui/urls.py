@@ -0,0 +1,22 @@
+"""
+URL Normalization
+
+One canonical form per page, shared by the app and the script pipeline,
+so both dedupe sources by the same rules.
+"""
+
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+
+TRACKING_PARAMS = {"fbclid", "gclid", "mc_cid", "mc_eid", "ref"}
+
+
+def canonical_url(url: str) -> str:
+    """
+    Dedupe key for a URL: drops fragments, utm_* and other tracking params,
+    host case and trailing slashes, so variants of one page collapse.
+    """
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+             if not (k.lower().startswith("utm_") or k.lower() in TRACKING_PARAMS)]
+    return urlunsplit((parts.scheme, parts.netloc.lower(), parts.path.rstrip('/'), urlencode(query), ''))